@@ -0,0 +1,92 @@
+# clients.py
+#
+# Shared Twilio and Firestore client factories. Importing this module is
+# cheap: each client is built lazily on first use and memoized per
+# worker, so multiple entrypoints importing it share one client of each
+# kind instead of re-initializing their own.
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+import functools
+import logging
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+from urllib3.util.retry import Retry
+
+# ------------------------------------------------------
+# Twilio Setup
+# ------------------------------------------------------
+TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")  # Replace with your Account SID
+TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")  # Replace with your Auth Token
+TWILIO_PHONE_NUMBER = os.environ.get("TWILIO_PHONE_NUMBER")  # Replace with your Twilio phone number
+
+# Hard deadlines so a hung backend can't stall a worker indefinitely.
+TWILIO_TIMEOUT_SECONDS = 2.0
+
+def _build_twilio_http_client() -> TwilioHttpClient:
+    """Build a Twilio HTTP client backed by a pooled, retrying Session.
+
+    Reusing one Session keeps TCP/TLS connections to Twilio alive across
+    sends instead of paying a fresh handshake per message.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    )
+    session.mount("https://", adapter)
+    http_client = TwilioHttpClient(timeout=TWILIO_TIMEOUT_SECONDS)
+    http_client.session = session
+    return http_client
+
+@functools.lru_cache(maxsize=1)
+def get_twilio():
+    """Per-worker Twilio client, built lazily on first send.
+
+    Deferring construction keeps cold starts short and means requests
+    that never touch Twilio never pay for it.
+    """
+    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN):
+        logging.warning("⚠️ Twilio credentials not found. WhatsApp messages will not be sent.")
+        return None
+    try:
+        client = Client(
+            TWILIO_ACCOUNT_SID,
+            TWILIO_AUTH_TOKEN,
+            http_client=_build_twilio_http_client(),
+        )
+        logging.info("✅ Twilio client initialized successfully.")
+        return client
+    except Exception as e:
+        logging.error("❌ Error initializing Twilio client: %s", e)
+        return None
+
+# ------------------------------------------------------
+# Firestore Setup
+# ------------------------------------------------------
+@functools.lru_cache(maxsize=1)
+def get_db():
+    """Per-worker Firestore client, built lazily on first feedback write."""
+    try:
+        cred = credentials.ApplicationDefault()
+        firebase_admin.initialize_app(cred)
+        db = firestore.client()
+        logging.info("✅ Firestore connected using Cloud Run environment credentials.")
+        return db
+    except ValueError:
+        try:
+            if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+                cred = credentials.Certificate(os.getenv("GOOGLE_APPLICATION_CREDENTIALS"))
+                firebase_admin.initialize_app(cred)
+                db = firestore.client()
+                logging.info("✅ Firestore connected using GOOGLE_APPLICATION_CREDENTIALS.")
+                return db
+            logging.warning("⚠️ No GOOGLE_APPLICATION_CREDENTIALS found. Running without Firestore.")
+        except Exception as e:
+            logging.error("❌ Error initializing Firebase: %s", e)
+            logging.warning("Continuing without database connection.")
+    return None
@@ -1,12 +1,21 @@
 # main.py
 
-from flask import Flask, request, jsonify
-import firebase_admin
-from firebase_admin import credentials, firestore
+from flask import Flask, request
+import orjson
+from firebase_admin import firestore
+from google.api_core.exceptions import DeadlineExceeded
+import atexit
+import concurrent.futures
+import collections
+import functools
 import logging
 import os
-import datetime
-from twilio.rest import Client
+import re
+import threading
+import time
+import requests
+
+from clients import TWILIO_PHONE_NUMBER, TWILIO_TIMEOUT_SECONDS, get_db, get_twilio
 
 # ------------------------------------------------------
 # Logging Configuration
@@ -22,46 +31,78 @@ logging.basicConfig(
 app = Flask(__name__)
 
 # ------------------------------------------------------
-# Twilio Setup
+# Message Constants
 # ------------------------------------------------------
-TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")  # Replace with your Account SID
-TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")  # Replace with your Auth Token
-TWILIO_PHONE_NUMBER = os.environ.get("TWILIO_PHONE_NUMBER")  # Replace with your Twilio phone number
+# Constant strings built once at import rather than per request.
+_WA_PREFIX = "whatsapp:"
+_WA_FROM = f"{_WA_PREFIX}{TWILIO_PHONE_NUMBER}"
+_SHARE_LINK = "https://example.com/share"
+_RECOMMEND_BODY = (
+    "👋 Hello! A friend thought you’d love our services. "
+    f"Check them out here: {_SHARE_LINK}"
+)
 
-twilio_client = None
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
+# ------------------------------------------------------
+# Background Worker
+# ------------------------------------------------------
+# WhatsApp sends go through this pool so the webhook never waits on
+# Twilio's HTTPS round-trip; queued sends drain on shutdown.
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+atexit.register(executor.shutdown, wait=True)
+
+def _log_twilio_result(future):
+    """Log the outcome of a background WhatsApp send."""
     try:
-        twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        logging.info("✅ Twilio client initialized successfully.")
+        success, response_message = future.result()
+        if success:
+            logging.info("✅ Background WhatsApp send completed.")
+        else:
+            logging.error("❌ Background WhatsApp send failed: %s", response_message)
     except Exception as e:
-        logging.error(f"❌ Error initializing Twilio client: {e}")
-else:
-    logging.warning("⚠️ Twilio credentials not found. WhatsApp messages will not be sent.")
+        logging.error("❌ Background WhatsApp send raised: %s", e)
 
+# Deletion table built once at import: every ASCII character that is not a
+# digit or '+'. str.translate runs the cleanup in C instead of calling a
+# Python predicate per character.
+_NON_DIGITS = str.maketrans(
+    "", "", "".join(chr(c) for c in range(128) if not chr(c).isdigit() and chr(c) != "+")
+)
+
+# UK mobile number (07... or bare 7...), compiled once at import so each
+# format runs a single C-level match instead of startswith/len checks.
+_UK_RE = re.compile(r"^0?7(\d{9})$")
+
+@functools.lru_cache(maxsize=4096)
 def format_phone_number(number: str) -> str:
     """
     Formats a phone number to E.164 format.
-    - If UK local (07...), convert to +44
+    - Strips spaces, dashes and other separators
+    - If UK local (07... or 7...), convert to +44
     - If no '+' prefix, add it
+
+    Memoized: the same recipients repeat across sessions, and E.164
+    numbers are short, so the bounded cache stays tiny.
     """
-    number = number.strip()
-    if number.startswith("07") and len(number) == 11:
-        return f"+44{number[1:]}"
+    number = number.translate(_NON_DIGITS)
+    m = _UK_RE.match(number)
+    if m:
+        return "+447" + m.group(1)
     if not number.startswith("+"):
         return f"+{number}"
     return number
 
 def send_whatsapp_message(to_number: str, message_body: str):
     """Send a WhatsApp message using Twilio API."""
+    twilio_client = get_twilio()
     if not twilio_client:
         return False, "⚠️ Sorry, messaging service is not available at the moment."
 
     try:
-        formatted_to = f"whatsapp:{format_phone_number(to_number)}"
-        logging.info(f"📤 Sending WhatsApp message to {formatted_to}")
+        formatted_to = _WA_PREFIX + format_phone_number(to_number)
+        logging.info("📤 Sending WhatsApp message to %s", formatted_to)
         twilio_client.messages.create(
             to=formatted_to,
-            from_=f"whatsapp:{TWILIO_PHONE_NUMBER}",
+            from_=_WA_FROM,
             body=message_body
         )
         logging.info("✅ WhatsApp message sent successfully.")
@@ -69,125 +110,224 @@ def send_whatsapp_message(to_number: str, message_body: str):
             f"🎉 Your recommendation has been shared with {to_number}. "
             "Thank you for helping us spread the word! 🙌"
         )
+    except requests.exceptions.Timeout:
+        logging.error("❌ WhatsApp send timed out after %ss.", TWILIO_TIMEOUT_SECONDS)
+        return False, "⏳ The messaging service is slow right now. Please try again later."
     except Exception as e:
-        logging.error(f"❌ Failed to send WhatsApp message: {e}")
+        logging.error("❌ Failed to send WhatsApp message: %s", e)
         return False, "❌ Sorry, we couldn’t deliver your message. Please try again later."
 
 # ------------------------------------------------------
-# Firestore Setup
+# Feedback Write Batching
 # ------------------------------------------------------
-db = None
-try:
-    cred = credentials.ApplicationDefault()
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    logging.info("✅ Firestore connected using Cloud Run environment credentials.")
-except ValueError:
-    try:
-        if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-            cred = credentials.Certificate(os.getenv("GOOGLE_APPLICATION_CREDENTIALS"))
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            logging.info("✅ Firestore connected using GOOGLE_APPLICATION_CREDENTIALS.")
-        else:
-            logging.warning("⚠️ No GOOGLE_APPLICATION_CREDENTIALS found. Running without Firestore.")
-    except Exception as e:
-        logging.error(f"❌ Error initializing Firebase: {e}")
-        logging.warning("Continuing without database connection.")
+# Feedback entries are buffered in-process and flushed to Firestore in
+# small WriteBatches, so the webhook never waits on a Firestore RPC.
+_FLUSH_INTERVAL_SECONDS = 2.0
+_FLUSH_BATCH_SIZE = 20  # small batches write faster than large ones
+_FIRESTORE_TIMEOUT_SECONDS = 1.5
+
+_feedback_buffer = collections.deque()
+_feedback_lock = threading.Lock()
+
+def _flush_feedback_buffer():
+    """Drain the buffer into Firestore, one WriteBatch per chunk."""
+    while True:
+        with _feedback_lock:
+            if not _feedback_buffer:
+                return
+            entries = [
+                _feedback_buffer.popleft()
+                for _ in range(min(len(_feedback_buffer), _FLUSH_BATCH_SIZE))
+            ]
+        db = get_db()
+        if db is None:
+            return
+        try:
+            batch = db.batch()
+            collection = db.collection("feedback")
+            for entry in entries:
+                batch.set(collection.document(), entry)
+            batch.commit(timeout=_FIRESTORE_TIMEOUT_SECONDS)
+            logging.info("💾 Flushed %d feedback entries to Firestore.", len(entries))
+        except DeadlineExceeded:
+            logging.error(
+                "❌ Firestore batch commit exceeded %ss deadline; retrying on next flush.",
+                _FIRESTORE_TIMEOUT_SECONDS,
+            )
+            with _feedback_lock:
+                _feedback_buffer.extendleft(reversed(entries))
+            return
+        except Exception as e:
+            logging.error("❌ Error flushing feedback batch to Firestore: %s", e)
+
+def _schedule_feedback_flush():
+    timer = threading.Timer(_FLUSH_INTERVAL_SECONDS, _schedule_feedback_flush)
+    timer.daemon = True
+    timer.start()
+    _flush_feedback_buffer()
+
+def _queue_feedback(feedback_text: str):
+    """Buffer one feedback entry; trigger an early flush on a full batch."""
+    with _feedback_lock:
+        _feedback_buffer.append({
+            "text": feedback_text,
+            # Set server-side on commit: no client clock call, no skew.
+            "timestamp": firestore.SERVER_TIMESTAMP
+        })
+        buffered = len(_feedback_buffer)
+    if buffered >= _FLUSH_BATCH_SIZE:
+        executor.submit(_flush_feedback_buffer)
+
+# The flush no-ops on an empty buffer, so starting the timer here does
+# not force a Firestore connection on workers that never see feedback.
+_schedule_feedback_flush()
+atexit.register(_flush_feedback_buffer)
 
 # ------------------------------------------------------
-# Webhook Endpoint
+# Per-Recipient Rate Limiting
 # ------------------------------------------------------
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    req = request.get_json(silent=True, force=True)
+# Sliding-window limiter so one recipient can't trigger unlimited Twilio
+# sends: at most _RATE_LIMIT_MAX_SENDS per number per window.
+_RATE_LIMIT_WINDOW_SECONDS = 60.0
+_RATE_LIMIT_MAX_SENDS = 5
 
-    # Default fallback response
-    fulfillment_response = {
+_send_history = collections.defaultdict(collections.deque)
+_rate_limit_lock = threading.Lock()
+
+def _allow_send(formatted_number: str) -> bool:
+    """Record one send attempt; False if the recipient is over the limit."""
+    now = time.monotonic()
+    cutoff = now - _RATE_LIMIT_WINDOW_SECONDS
+    with _rate_limit_lock:
+        history = _send_history[formatted_number]
+        while history and history[0] < cutoff:
+            history.popleft()
+        if len(history) >= _RATE_LIMIT_MAX_SENDS:
+            return False
+        history.append(now)
+        return True
+
+# ------------------------------------------------------
+# Fulfillment Responses
+# ------------------------------------------------------
+def _text_response(message: str) -> dict:
+    """Build a Dialogflow fulfillment response carrying one text message."""
+    return {
         "fulfillmentResponse": {
-            "messages": [
-                {"text": {"text": ["I'm sorry, I didn't understand that. Could you please rephrase?"]}}
-            ]
+            "messages": [{"text": {"text": [message]}}]
         }
     }
 
+def _respond(obj: dict):
+    """Serialize a fulfillment response with orjson (faster than stdlib json)."""
+    return app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+def _cached_response(message: str):
+    """Pre-serialize a constant fulfillment response once at import."""
+    return _respond(_text_response(message))
+
+_FALLBACK_RESP = _cached_response(
+    "I'm sorry, I didn't understand that. Could you please rephrase?"
+)
+_FEEDBACK_THANKS_RESP = _cached_response(
+    "🌟 Thank you so much for sharing your feedback! "
+    "Your thoughts help us improve and serve you better. 🙌"
+)
+_NO_PHONE_RESP = _cached_response(
+    "📱 Please provide a valid phone number so we can share the link."
+)
+# Empty fulfillment for intents with nothing to say: Dialogflow keeps its
+# own flow messages, and we skip response construction entirely.
+_EMPTY_RESP = app.response_class(
+    b'{"fulfillmentResponse":{}}', mimetype="application/json"
+)
+_RATE_LIMITED_RESP = _cached_response(
+    "⏳ We've already sent a few messages to that number recently. "
+    "Please try again in a minute."
+)
+
+# ------------------------------------------------------
+# Intent Handlers
+# ------------------------------------------------------
+def _handle_feedback(parameters: dict):
+    """Buffer feedback for the batched Firestore flush."""
+    feedback_text = parameters.get("feedback_text")
+    if feedback_text and get_db() is not None:
+        _queue_feedback(feedback_text)
+        return _FEEDBACK_THANKS_RESP
+    return None  # Do not override other flows if no feedback text.
+
+def _handle_recommend(parameters: dict):
+    """Queue a WhatsApp recommendation send."""
+    recipient_number = parameters.get("recipient_phone_number")
+    if not recipient_number:
+        return _NO_PHONE_RESP
+    if not _allow_send(format_phone_number(recipient_number)):
+        return _RATE_LIMITED_RESP
+    future = executor.submit(send_whatsapp_message, recipient_number, _RECOMMEND_BODY)
+    future.add_done_callback(_log_twilio_result)
+    return _respond(_text_response(
+        f"📤 Your recommendation is being sent to {recipient_number}. "
+        "Thank you for helping us spread the word! 🙌"
+    ))
+
+# O(1) dispatch by intent display name or fulfillment tag, instead of an
+# if/elif chain that grows with every new intent.
+_HANDLERS = {
+    "FeedbackIntent": _handle_feedback,
+    "feedback-recommend": _handle_feedback,
+    "RecommendIntent": _handle_recommend,
+    "recommend-share": _handle_recommend,
+}
+
+# ------------------------------------------------------
+# Webhook Endpoint
+# ------------------------------------------------------
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    # Parse the body once with orjson rather than get_json(force=True),
+    # skipping Flask's mimetype sniffing and the slower stdlib parser.
+    raw = request.get_data(cache=False)
+    try:
+        req = orjson.loads(raw) if raw else {}
+    except orjson.JSONDecodeError:
+        return _FALLBACK_RESP
+
+    # Cheap shape check so bogus traffic (scanners, malformed bots) pays
+    # for one dict probe instead of the full handler path.
+    if not isinstance(req, dict) or (
+        "intentInfo" not in req and "fulfillmentInfo" not in req
+    ):
+        return _FALLBACK_RESP
+
     try:
         intent_display_name = req.get("intentInfo", {}).get("displayName")
         tag = req.get("fulfillmentInfo", {}).get("tag")
         parameters = req.get("sessionInfo", {}).get("parameters", {})
 
-        logging.info(f"🎯 Intent: {intent_display_name}, Tag: {tag}, Parameters: {parameters}")
-
-        # --- Handle Feedback ---
-        if intent_display_name == "FeedbackIntent" or (
-            tag == "feedback-recommend" and parameters.get("feedback_text")
-        ):
-            feedback_text = parameters.get("feedback_text")
-            if feedback_text and db is not None:
-                try:
-                    doc_ref = db.collection("feedback").add({
-                        "text": feedback_text,
-                        "timestamp": datetime.datetime.utcnow()
-                    })
-                    logging.info(f"💾 Feedback saved with ID: {doc_ref[1].id}")
-                    message = (
-                        "🌟 Thank you so much for sharing your feedback! "
-                        "Your thoughts help us improve and serve you better. 🙌"
-                    )
-                except Exception as e:
-                    logging.error(f"❌ Error saving feedback to Firestore: {e}")
-                    message = (
-                        "⚠️ Sorry, something went wrong while saving your feedback. "
-                        "Please try again later."
-                    )
-            else:
-                message = None  # Do not override other flows if no feedback text
-
-            if message:
-                fulfillment_response = {
-                    "fulfillmentResponse": {
-                        "messages": [{"text": {"text": [message]}}]
-                    }
-                }
-
-        # --- Handle Recommend ---
-        elif intent_display_name == "RecommendIntent" or tag == "recommend-share":
-            recipient_number = parameters.get("recipient_phone_number")
-            share_link = "https://example.com/share"
-            message_body = (
-                "👋 Hello! A friend thought you’d love our services. "
-                f"Check them out here: {share_link}"
-            )
+        logging.info("🎯 Intent: %s, Tag: %s", intent_display_name, tag)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("🎯 Parameters: %r", parameters)
 
-            if recipient_number:
-                success, response_message = send_whatsapp_message(recipient_number, message_body)
-                fulfillment_response = {
-                    "fulfillmentResponse": {
-                        "messages": [{"text": {"text": [response_message]}}]
-                    }
-                }
-            else:
-                fulfillment_response = {
-                    "fulfillmentResponse": {
-                        "messages": [
-                            {"text": {"text": ["📱 Please provide a valid phone number so we can share the link."]}}
-                        ]
-                    }
-                }
+        handler = _HANDLERS.get(intent_display_name) or _HANDLERS.get(tag)
+        if handler:
+            response = handler(parameters)
+            # A matched handler with nothing to say returns the empty
+            # fulfillment rather than overriding the flow's own messages.
+            return response if response is not None else _EMPTY_RESP
 
     except Exception as e:
-        logging.error(f"❌ Webhook error: {e}")
-        fulfillment_response = {
-            "fulfillmentResponse": {
-                "messages": [{"text": {"text": [f"Unexpected error: {e}"]}}]
-            }
-        }
+        logging.error("❌ Webhook error: %s", e)
+        return _respond(_text_response(f"Unexpected error: {e}"))
 
-    return jsonify(fulfillment_response)
+    return _FALLBACK_RESP
 
 # ------------------------------------------------------
 # App Runner
 # ------------------------------------------------------
+# Production runs under gunicorn (see Procfile); the dev server below is
+# only for local use, with debug gated behind FLASK_ENV=development.
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
-    app.run(debug=True, host="0.0.0.0", port=port)
+    debug = os.getenv("FLASK_ENV") == "development"
+    app.run(debug=debug, host="0.0.0.0", port=port)